@@ -1,19 +1,69 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pymongo import MongoClient, UpdateOne
 
+# Shared session: HTTP keep-alive avoids a TCP+TLS handshake per page, and
+# transient failures (connect errors, 429/5xx) retry with backoff
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=requests.adapters.Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+))
+
+try:
+    import orjson
+
+    def _json_loads(resp):
+        # orjson decodes straight from bytes, 2-5x faster than stdlib json
+        return orjson.loads(resp.content)
+except ImportError:
+    def _json_loads(resp):
+        return resp.json()
+
+try:
+    # C parser: ~20x faster than fromisoformat and no .replace() round-trip
+    from ciso8601 import parse_datetime as _parse_datetime
+except ImportError:
+    def _parse_datetime(ts_str):
+        return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
+
+
+def _attach_epoch_ts(market):
+    """Pre-parse ISO open/close times into epoch-second ints at ingestion.
+
+    Downstream steps (duration filter, candlestick fetch windows) then compare
+    plain integers instead of re-parsing the same ISO strings on every run.
+    Parse failures just leave the field off; consumers fall back to the string.
+    """
+    for src, dst in (("open_time", "open_ts"), ("close_time", "close_ts")):
+        value = market.get(src)
+        if value:
+            try:
+                market[dst] = int(_parse_datetime(value).timestamp())
+            except Exception:
+                pass
+
+
+
 def fetch_markets_by_status(status, max_markets=10000, collection=None, batch_size=1000):
     url = "https://api.elections.kalshi.com/trade-api/v2/markets"
     params = {"limit": 1000, "status": status}
     
-    session = requests.Session()  # ✅ reuse TCP connections
-    all_markets = []
-    buffer = []
     total_fetched = 0
     cursor = None
+    pending = None  # in-flight write of the previous batch
 
     def write_batch(batch, col):
         if col is None or not batch:
             return
+        for m in batch:
+            _attach_epoch_ts(m)
         # ✅ Bulk upsert using a single round-trip
         ops = [
             UpdateOne({"ticker": m.get("ticker")}, {"$set": m}, upsert=True)
@@ -23,6 +73,10 @@ def fetch_markets_by_status(status, max_markets=10000, collection=None, batch_si
         print(f"Stored batch: {len(batch)} {status} markets "
               f"(matched: {result.matched_count}, upserted: {result.upserted_count})")
 
+    # One background writer overlaps each batch's Mongo upserts with the next
+    # page fetch; both are latency-bound and were strictly serial before
+    writer = ThreadPoolExecutor(max_workers=1)
+
     while total_fetched < max_markets:
         if cursor:
             params["cursor"] = cursor
@@ -32,7 +86,7 @@ def fetch_markets_by_status(status, max_markets=10000, collection=None, batch_si
         try:
             resp = session.get(url, params=params, timeout=20)
             resp.raise_for_status()
-            data = resp.json()
+            data = _json_loads(resp)
         except Exception as e:
             print(f"Request failed for status='{status}': {e}")
             break
@@ -45,26 +99,29 @@ def fetch_markets_by_status(status, max_markets=10000, collection=None, batch_si
         if not markets:
             break
 
-        for market in markets:
-            if total_fetched >= max_markets:
-                break
-            buffer.append(market)
-            all_markets.append(market)
-            total_fetched += 1
-
-            if len(buffer) >= batch_size:
-                write_batch(buffer, collection)
-                buffer.clear()
+        # Pages arrive batch-sized already, so hand page slices straight to the
+        # writer instead of appending market-by-market into an intermediate
+        # buffer (each slice is a fresh list, safe to write in the background)
+        take = min(len(markets), max_markets - total_fetched)
+        page = markets[:take]
+        total_fetched += take
+        for i in range(0, take, batch_size):
+            if pending is not None:
+                pending.result()  # at most one write in flight; surface errors
+            pending = writer.submit(write_batch, page[i:i + batch_size], collection)
 
         print(f"Fetched {len(markets)} {status} markets. Total fetched: {total_fetched}")
         cursor = data.get("cursor")
         if not cursor:
             break
 
-    if buffer:
-        write_batch(buffer, collection)
+    if pending is not None:
+        pending.result()
+    writer.shutdown()
 
-    return all_markets
+    # Only the count is needed downstream; keeping every market in a list
+    # would grow Python RSS to GBs over a multi-million market run
+    return total_fetched
 
 
 def main():
@@ -76,12 +133,12 @@ def main():
     col.create_index("ticker", unique=True)
 
     print("Fetching closed markets...")
-    closed_markets = fetch_markets_by_status("closed", max_markets=10_000_000, collection=col)
+    closed_count = fetch_markets_by_status("closed", max_markets=10_000_000, collection=col)
 
     print("\nFetching settled markets...")
-    settled_markets = fetch_markets_by_status("settled", max_markets=10_000_000, collection=col)
+    settled_count = fetch_markets_by_status("settled", max_markets=10_000_000, collection=col)
 
-    print(f"\nCompleted: {len(closed_markets)} closed and {len(settled_markets)} settled markets.")
+    print(f"\nCompleted: {closed_count} closed and {settled_count} settled markets.")
 
 if __name__ == "__main__":
     main()
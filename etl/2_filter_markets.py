@@ -1,59 +1,147 @@
 from datetime import datetime
-from pymongo import MongoClient
+from functools import lru_cache
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import OperationFailure
 from tqdm import tqdm
 
+try:
+	# C parser: ~20x faster than fromisoformat and no .replace() round-trip
+	from ciso8601 import parse_datetime as _parse_datetime
+except ImportError:
+	def _parse_datetime(ts_str):
+		return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
+
+
+# One month as 30 days
+_ONE_MONTH_DAYS = 30
 
+
+@lru_cache(maxsize=200_000)
 def _parse_iso_utc(ts_str):
-	"""Parse ISO8601 timestamp strings that may end with 'Z' into aware datetimes."""
+	"""Parse ISO8601 timestamp strings that may end with 'Z' into aware datetimes.
+
+	Cached: open/close strings repeat across markets in the same event, and the
+	fallback path parses each market's pair once per run anyway.
+	"""
 	if not ts_str:
 		return None
 	try:
-		return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
+		return _parse_datetime(ts_str)
 	except Exception:
 		return None
 
 
 def _is_open_longer_than_one_month(market):
+	# Fast path: step_1 attaches pre-parsed epoch-second ints at ingestion,
+	# so the common case is a single integer subtraction with no ISO parsing
+	open_ts = market.get("open_ts")
+	close_ts = market.get("close_ts")
+	if open_ts is not None and close_ts is not None:
+		return close_ts - open_ts >= _ONE_MONTH_DAYS * 86400
 	open_time_str = market.get("open_time")
 	close_time_str = market.get("close_time")
 	open_dt = _parse_iso_utc(open_time_str)
 	close_dt = _parse_iso_utc(close_time_str)
 	if not open_dt or not close_dt:
 		return False
-	# One month as 30 days using total seconds for accuracy
-	duration_seconds = (close_dt - open_dt).total_seconds()
-	return duration_seconds >= 30 * 24 * 60 * 60
+	# Integer-day comparison: no timedelta.total_seconds() float math per market
+	return (close_dt - open_dt).days >= _ONE_MONTH_DAYS
+
+
+def filter_markets_server_side(step_1_col):
+	"""Run the volume/duration filter as a MongoDB aggregation and $merge into step_22.
+
+	The match, the date arithmetic and the writes all execute inside mongod, so
+	rejected markets are never decoded in Python and accepted ones never cross
+	the wire. Raises OperationFailure on servers without $dateDiff (pre-5.0).
+	"""
+	pipeline = [
+		# Single $match: the indexed volume predicate narrows first, then the
+		# duration check runs as one expression with no temp field. Documents
+		# ingested with pre-parsed open_ts/close_ts ints use a plain $subtract;
+		# older documents fall back to $dateDiff over the ISO strings.
+		{"$match": {
+			"volume": {"$gt": 0},
+			"open_time": {"$exists": True, "$ne": None},
+			"close_time": {"$exists": True, "$ne": None},
+			"$expr": {"$cond": [
+				{"$and": [{"$isNumber": "$open_ts"}, {"$isNumber": "$close_ts"}]},
+				{"$gte": [
+					{"$subtract": ["$close_ts", "$open_ts"]},
+					_ONE_MONTH_DAYS * 86400,
+				]},
+				{"$gte": [
+					{"$dateDiff": {
+						"startDate": {"$toDate": "$open_time"},
+						"endDate": {"$toDate": "$close_time"},
+						"unit": "day",
+					}},
+					_ONE_MONTH_DAYS,
+				]},
+			]},
+		}},
+		{"$unset": "_id"},
+		{"$merge": {
+			"into": "step_22",
+			"on": "ticker",
+			"whenMatched": "replace",
+			"whenNotMatched": "insert",
+		}},
+	]
+	step_1_col.aggregate(pipeline, allowDiskUse=True)
 
 
 def main():
 	client = MongoClient("mongodb://localhost:27017")
 	db = client["tail-end-analysis"]
-	
-	# Read all markets from step_1
+
 	step_1_col = db["step_11"]
-	print("Loading markets from MongoDB...")
-	all_markets = list(step_1_col.find())
-	print(f"Found {len(all_markets)} markets in step_11")
-	
-	# Filter: volume > 0 and duration >= 1 month
+	step_2_col = db["step_22"]
+	# Unique ticker index so $merge / upserts are index-backed, and a volume
+	# index so the $match narrows via the index before the date arithmetic
+	step_2_col.create_index("ticker", unique=True)
+	step_1_col.create_index("volume")
+
+	total = step_1_col.count_documents({})
+	print(f"Found {total} markets in step_11")
+
+	try:
+		print("Filtering server-side via aggregation (merged into step_22)...")
+		filter_markets_server_side(step_1_col)
+		stored = step_2_col.count_documents({})
+		print(
+			f"Stored {stored} markets with volume>0 and open>=1 month "
+			f"(out of {total} total) into MongoDB collection 'step_22'."
+		)
+		return
+	except OperationFailure as e:
+		print(f"Aggregation not supported ({e}), filtering client-side...")
+
+	# Fallback: stream markets from step_1 and filter in Python. The volume
+	# predicate is pushed into the find() so zero-volume markets never cross
+	# the wire; only the date arithmetic stays client-side.
 	print("Filtering markets...")
+	cursor = step_1_col.find({"volume": {"$gt": 0}}).batch_size(1000)
 	filtered = [
-		m for m in tqdm(all_markets, desc="Filtering", unit="market")
-		if (m.get("volume") or 0) > 0
-		and _is_open_longer_than_one_month(m)
+		m for m in tqdm(cursor, desc="Filtering", unit="market")
+		if _is_open_longer_than_one_month(m)
 	]
-	
+
 	print(
 		f"Filtered: {len(filtered)} markets with volume>0 and open>=1 month "
-		f"(out of {len(all_markets)} total)"
+		f"(out of {total} total)"
 	)
-	
-	# Store filtered markets in step_2
-	step_2_col = db["step_22"]
+
+	# Store filtered markets in step_2 (bulk upserts, one round-trip per batch)
 	print("Storing filtered markets to MongoDB...")
-	for m in tqdm(filtered, desc="Storing", unit="market"):
-		step_2_col.replace_one({"ticker": m.get("ticker")}, m, upsert=True)
-	
+	batch_size = 1000
+	for start in tqdm(range(0, len(filtered), batch_size), desc="Storing", unit="batch"):
+		ops = [
+			ReplaceOne({"ticker": m.get("ticker")}, m, upsert=True)
+			for m in filtered[start:start + batch_size]
+		]
+		step_2_col.bulk_write(ops, ordered=False)
+
 	print(f"Stored {len(filtered)} markets into MongoDB collection 'step_22'.")
 
 
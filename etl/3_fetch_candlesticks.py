@@ -1,12 +1,61 @@
 import requests
-from datetime import datetime, timedelta
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import lru_cache
 from pymongo import MongoClient
 import time
 
+try:
+	import orjson
 
-def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, period_interval=1440, chunk_days=30, max_retries=3, retry_delay=1):
+	def _json_loads(resp):
+		# orjson decodes straight from bytes, 2-5x faster than stdlib json
+		return orjson.loads(resp.content)
+except ImportError:
+	def _json_loads(resp):
+		return resp.json()
+
+try:
+	# C parser: ~20x faster than fromisoformat and no .replace() round-trip
+	from ciso8601 import parse_datetime as _parse_datetime
+except ImportError:
+	def _parse_datetime(ts_str):
+		return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
+
+
+@lru_cache(maxsize=100_000)
+def _parse_iso_utc(ts_str):
+	"""Parse an ISO8601 'Z' timestamp. Cached: each market's open/close pair is
+	parsed once even when several candidate series are tried for it."""
+	return _parse_datetime(ts_str)
+
+
+# Configuration
+EXTEND_DAYS_BEFORE = 60  # Days to extend before market open
+EXTEND_DAYS_AFTER = 60   # Days to extend after market close
+CHUNK_DAYS = 30          # Days per chunk for pagination
+# Period intervals to fetch: 1440 (1-day), 60 (1-hour), 1 (1-minute)
+# Note: 1-minute data can be very large - enable only if needed
+PERIOD_INTERVALS = [1440]  # Daily only
+MAX_WORKERS = 16         # Concurrent markets in flight (workload is network-bound)
+
+# Shared session: HTTP keep-alive + TLS session reuse across all requests, with
+# a pool large enough for every worker thread to hold a connection. Transient
+# connection/read errors are retried at the adapter level; HTTP status retries
+# (429/5xx with Retry-After) stay in the fetch loop below.
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(
+	pool_connections=32,
+	pool_maxsize=32,
+	max_retries=requests.adapters.Retry(total=3, backoff_factor=0.5),
+))
+
+
+def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, period_interval=1440, chunk_days=30, max_retries=3, retry_delay=1, on_chunk=None):
 	"""Fetch candlestick data in chunks to handle API limits and ensure complete data retrieval.
-	
+
 	Args:
 		series_ticker: The series ticker identifier
 		market_ticker: The market ticker identifier
@@ -16,7 +65,8 @@ def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, p
 		chunk_days: Number of days per chunk (default 30)
 		max_retries: Maximum retry attempts for failed requests
 		retry_delay: Initial delay between retries (seconds)
-	
+		on_chunk: Optional callback invoked with each chunk's candles as they arrive
+
 	Returns:
 		List of candlestick dictionaries
 	"""
@@ -40,7 +90,7 @@ def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, p
 		chunk_candles = []
 		for attempt in range(max_retries):
 			try:
-				resp = requests.get(url, params=params, timeout=20)
+				resp = session.get(url, params=params, timeout=20)
 				
 				# Handle rate limiting (429)
 				if resp.status_code == 429:
@@ -61,7 +111,7 @@ def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, p
 						break
 				
 				# Success - parse response
-				data = resp.json()
+				data = _json_loads(resp)
 				chunk_candles = data.get("candlesticks", [])
 				break
 				
@@ -79,6 +129,8 @@ def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, p
 		
 		if chunk_candles:
 			all_candlesticks.extend(chunk_candles)
+			if on_chunk:
+				on_chunk(chunk_candles)
 			print(f"    Fetched {len(chunk_candles)} candles for chunk [{datetime.fromtimestamp(chunk_start)} to {datetime.fromtimestamp(chunk_end)}]")
 		
 		chunk_start = chunk_end
@@ -89,40 +141,6 @@ def fetch_candlesticks_chunked(series_ticker, market_ticker, start_ts, end_ts, p
 	return all_candlesticks
 
 
-def fetch_candlesticks(series_ticker, market_ticker, market_open_time, market_close_time, period_interval=1440, extend_days_before=30, extend_days_after=30, chunk_days=30):
-	"""Fetch candlestick data for a market. period_interval: 1 (1min), 60 (1hr), 1440 (1day)
-	Extends time range before open_time and after close_time to get more data.
-	Uses chunking to ensure all available data is retrieved."""
-	try:
-		open_dt = datetime.fromisoformat(market_open_time.replace("Z", "+00:00"))
-		close_dt = datetime.fromisoformat(market_close_time.replace("Z", "+00:00"))
-		
-		# Extend time range: go back extend_days_before days before open, and extend_days_after days after close
-		start_dt = open_dt - timedelta(days=extend_days_before)
-		end_dt = close_dt + timedelta(days=extend_days_after)
-		
-		# Also extend to current time if close_time is in the past
-		now = datetime.now(start_dt.tzinfo)
-		if end_dt < now:
-			end_dt = now
-		
-		start_ts = int(start_dt.timestamp())
-		end_ts = int(end_dt.timestamp())
-		
-		# Use chunked fetching to ensure complete data retrieval
-		return fetch_candlesticks_chunked(
-			series_ticker, 
-			market_ticker, 
-			start_ts, 
-			end_ts, 
-			period_interval=period_interval,
-			chunk_days=chunk_days
-		)
-	except Exception as e:
-		print(f"    Error in fetch_candlesticks: {e}")
-		return []
-
-
 def get_series_ticker_for_event(event_ticker, max_retries=3, retry_delay=1):
 	"""Try to get series_ticker for a specific event_ticker with retry logic"""
 	events_url = "https://api.elections.kalshi.com/trade-api/v2/events"
@@ -130,7 +148,7 @@ def get_series_ticker_for_event(event_ticker, max_retries=3, retry_delay=1):
 	
 	for attempt in range(max_retries):
 		try:
-			resp = requests.get(events_url, params=params, timeout=20)
+			resp = session.get(events_url, params=params, timeout=20)
 			
 			# Handle rate limiting
 			if resp.status_code == 429:
@@ -139,7 +157,7 @@ def get_series_ticker_for_event(event_ticker, max_retries=3, retry_delay=1):
 				continue
 			
 			if resp.ok:
-				data = resp.json()
+				data = _json_loads(resp)
 				events = data.get("events", [])
 				if events:
 					series_ticker = events[0].get("series_ticker")
@@ -163,140 +181,276 @@ def get_series_ticker_for_event(event_ticker, max_retries=3, retry_delay=1):
 	return None
 
 
+# Guards the in-memory cache when workers learn new mappings concurrently
+_cache_lock = threading.Lock()
+
+
+def cache_series_ticker(event_to_series_cache, series_cache_col, event_ticker, series_ticker):
+	"""Record a learned event->series mapping in memory and persist it to MongoDB."""
+	with _cache_lock:
+		event_to_series_cache[event_ticker] = series_ticker
+	if series_cache_col is not None:
+		try:
+			series_cache_col.update_one(
+				{"_id": event_ticker},
+				{"$set": {"series_ticker": series_ticker, "ts": datetime.utcnow()}},
+				upsert=True,
+			)
+		except Exception as e:
+			print(f"  (series_cache write failed for {event_ticker}: {e})")
+
+
+def prefetch_series_tickers(markets, event_to_series_cache, series_cache_col, executor):
+	"""Resolve series tickers for every unseen event_ticker up front.
+
+	The /events endpoint takes one event_ticker per call, so the lookups are
+	fanned out through the worker pool in one burst instead of being issued
+	lazily (and serially per worker) inside the market loop.
+	"""
+	unique_events = {
+		m["event_ticker"]
+		for m in markets
+		if m.get("event_ticker")
+		and not m.get("series_ticker")
+		and m["event_ticker"] not in event_to_series_cache
+	}
+	if not unique_events:
+		return
+
+	print(f"Prefetching series tickers for {len(unique_events)} events...")
+	futures = {executor.submit(get_series_ticker_for_event, ev): ev for ev in unique_events}
+	resolved = 0
+	for future in as_completed(futures):
+		series_ticker = future.result()
+		if series_ticker:
+			cache_series_ticker(event_to_series_cache, series_cache_col, futures[future], series_ticker)
+			resolved += 1
+	print(f"Resolved {resolved}/{len(unique_events)} event->series mappings")
+
+
+def process_market(market, step_3_col, event_to_series_cache, series_cache_col=None):
+	"""Fetch and store candlesticks for one market.
+
+	Returns "success", "skip" or "error". Safe to run from multiple threads:
+	pymongo collections are thread-safe and the cache dict is only read/written
+	with atomic operations.
+	"""
+	ticker = market.get("ticker")
+	event_ticker = market.get("event_ticker")
+	open_time = market.get("open_time")
+	close_time = market.get("close_time")
+
+	if not all([ticker, event_ticker, open_time, close_time]):
+		print(f"Skipping {ticker}: missing required fields")
+		return "skip"
+
+	# Compute the fetch window once per market: every candidate series and
+	# period interval below reuses the same start/end timestamps instead of
+	# re-parsing the open/close strings on each attempt. Pre-parsed epoch ints
+	# from step 1 are used when present.
+	try:
+		open_ts = market.get("open_ts")
+		close_ts = market.get("close_ts")
+		if open_ts is None or close_ts is None:
+			open_ts = int(_parse_iso_utc(open_time).timestamp())
+			close_ts = int(_parse_iso_utc(close_time).timestamp())
+		start_ts = open_ts - EXTEND_DAYS_BEFORE * 86400
+		# Also extend to current time if close_time is in the past
+		end_ts = max(close_ts + EXTEND_DAYS_AFTER * 86400, int(time.time()))
+	except Exception as e:
+		print(f"Skipping {ticker}: could not parse open/close time ({e})")
+		return "skip"
+
+	# Try to get series_ticker from cache, market, or API
+	series_ticker = market.get("series_ticker")
+	if not series_ticker:
+		series_ticker = event_to_series_cache.get(event_ticker)
+		if not series_ticker:
+			series_ticker = get_series_ticker_for_event(event_ticker)
+			if series_ticker:
+				cache_series_ticker(event_to_series_cache, series_cache_col, event_ticker, series_ticker)
+
+	# Try variations: event_ticker as series_ticker, or try fetching candlesticks directly
+	series_tickers_to_try = []
+	if series_ticker:
+		series_tickers_to_try.append(series_ticker)
+	series_tickers_to_try.append(event_ticker)  # Try event_ticker as series_ticker
+
+	for candidate_series in series_tickers_to_try:
+		try:
+			print(f"Trying series_ticker '{candidate_series}' for {ticker}...")
+
+			# Candlesticks are written incrementally as each chunk arrives:
+			# the first chunk resets the document (base market fields, empty
+			# candlesticks array), every chunk then appends via $push/$each so
+			# only the delta crosses the wire — never the whole grown array.
+			# Dedup happens against the seen-key set before pushing; chunks
+			# arrive in chronological order, so stored order stays sorted.
+			state = {"stored": 0, "seen": set(), "started": False}
+
+			def store_chunk(chunk_candles, _state=state):
+				fresh = []
+				for candle in chunk_candles:
+					ts = candle.get("end_period_ts")
+					interval = candle.get("period_interval")
+					key = (ts, interval) if ts and interval else ts
+					if key and key not in _state["seen"]:
+						_state["seen"].add(key)
+						# Pre-bake the effective price in cents (close, else mean)
+						# so downstream filters do one flat lookup per candle
+						price_obj = candle.get("price") or {}
+						px = price_obj.get("close")
+						if px is None:
+							px = price_obj.get("mean")
+						candle["_px_cents"] = px
+						fresh.append(candle)
+				if not fresh:
+					return
+				if not _state["started"]:
+					base = {k: v for k, v in market.items() if k not in ("_id", "candlesticks")}
+					base["candlesticks"] = []
+					# The reset also drops any stale fetch_complete flag so a
+					# refetch interrupted mid-way is not mistaken for done
+					step_3_col.update_one(
+						{"ticker": ticker},
+						{"$set": base, "$unset": {"fetch_complete": ""}},
+						upsert=True,
+					)
+					_state["started"] = True
+				step_3_col.update_one(
+					{"ticker": ticker},
+					{"$push": {"candlesticks": {"$each": fresh}}},
+				)
+				_state["stored"] += len(fresh)
+
+			for period_interval in PERIOD_INTERVALS:
+				interval_name = "1-day" if period_interval == 1440 else "1-hour" if period_interval == 60 else f"{period_interval}-min"
+
+				candles = fetch_candlesticks_chunked(
+					candidate_series,
+					ticker,
+					start_ts,
+					end_ts,
+					period_interval=period_interval,
+					chunk_days=CHUNK_DAYS,
+					on_chunk=store_chunk
+				)
+				if candles:
+					print(f"  ✓ {ticker} {interval_name}: {len(candles)} candles")
+				elif period_interval == 1440:
+					# Some short-lived markets have no daily candles at all;
+					# only then is the 24x more expensive hourly fetch worth it
+					print(f"  … {ticker}: no daily candles, retrying at 1-hour resolution")
+					candles = fetch_candlesticks_chunked(
+						candidate_series,
+						ticker,
+						start_ts,
+						end_ts,
+						period_interval=60,
+						chunk_days=CHUNK_DAYS,
+						on_chunk=store_chunk
+					)
+					if candles:
+						print(f"  ✓ {ticker} 1-hour: {len(candles)} candles")
+
+			if state["stored"]:
+				if candidate_series != event_ticker:
+					cache_series_ticker(event_to_series_cache, series_cache_col, event_ticker, candidate_series)
+				# Mark the fetch complete only once every interval finished:
+				# a crash or Mongo error mid-market leaves a document without
+				# this flag, so the next run refetches it instead of treating
+				# the truncated history as done
+				step_3_col.update_one({"ticker": ticker}, {"$set": {"fetch_complete": True}})
+				print(f"  ✓ {ticker}: stored {state['stored']} candlesticks")
+				return "success"
+		except Exception as e:
+			print(f"  ✗ Error processing {candidate_series}: {e}")
+			continue
+
+	print(f"  ✗ {ticker}: no candlesticks returned (tried {len(series_tickers_to_try)} series_ticker(s))")
+	return "error"
+
+
 def main():
-	# Configuration
-	EXTEND_DAYS_BEFORE = 60  # Days to extend before market open
-	EXTEND_DAYS_AFTER = 60   # Days to extend after market close
-	CHUNK_DAYS = 30          # Days per chunk for pagination
-	# Period intervals to fetch: 1440 (1-day), 60 (1-hour), 1 (1-minute)
-	# Note: 1-minute data can be very large - enable only if needed
-	PERIOD_INTERVALS = [1440]  # Daily only
-	
 	client = MongoClient("mongodb://localhost:27017")
 	db = client["tail-end-analysis"]
-	
+
+	# Concurrency is tunable per run (--workers N) so it can be raised until
+	# the API rate limit bites, or lowered on constrained links
+	max_workers = MAX_WORKERS
+	if "--workers" in sys.argv:
+		try:
+			max_workers = max(1, int(sys.argv[sys.argv.index("--workers") + 1]))
+		except (IndexError, ValueError):
+			print(f"Invalid --workers value, using default ({MAX_WORKERS})")
+
 	# Read all markets from step_2
 	step_2_col = db["step_22"]
-	markets = list(step_2_col.find())
+	markets = list(step_2_col.find().batch_size(1000))
 	print(f"Found {len(markets)} markets in step_2")
 	print(f"Configuration:")
 	print(f"  Time extension: ±{EXTEND_DAYS_BEFORE} days")
 	print(f"  Chunk size: {CHUNK_DAYS} days")
 	print(f"  Period intervals: {PERIOD_INTERVALS} minutes ({', '.join(['1-day' if x==1440 else '1-hour' if x==60 else f'{x}-min' for x in PERIOD_INTERVALS])})")
+	print(f"  Workers: {max_workers}")
 	print()
-	
+
 	if not markets:
 		print("No markets found in step_2. Exiting.")
 		return
-	
+
 	# Store candlesticks in step_3
 	step_3_col = db["step_33"]
-	
-	success_count = 0
-	skip_count = 0
-	error_count = 0
-	event_to_series_cache = {}  # Cache to avoid repeated API calls
-	
-	for i, market in enumerate(markets, 1):
-		ticker = market.get("ticker")
-		event_ticker = market.get("event_ticker")
-		open_time = market.get("open_time")
-		close_time = market.get("close_time")
-		
-		if not all([ticker, event_ticker, open_time, close_time]):
-			print(f"[{i}/{len(markets)}] Skipping {ticker}: missing required fields")
-			skip_count += 1
-			continue
-		
-		# Try to get series_ticker from cache, market, or API
-		series_ticker = market.get("series_ticker")
-		if not series_ticker:
-			series_ticker = event_to_series_cache.get(event_ticker)
-			if not series_ticker:
-				series_ticker = get_series_ticker_for_event(event_ticker)
-				if series_ticker:
-					event_to_series_cache[event_ticker] = series_ticker
-		
-		# Try variations: event_ticker as series_ticker, or try fetching candlesticks directly
-		series_tickers_to_try = []
-		if series_ticker:
-			series_tickers_to_try.append(series_ticker)
-		series_tickers_to_try.append(event_ticker)  # Try event_ticker as series_ticker
-		
-		candlesticks = None
-		successful_series = None
-		
-		for candidate_series in series_tickers_to_try:
-			try:
-				print(f"[{i}/{len(markets)}] Trying series_ticker '{candidate_series}' for {ticker}...")
-				
-				# Fetch multiple period intervals and combine results
-				all_candlesticks = []
-				
-				for period_interval in PERIOD_INTERVALS:
-					interval_name = "1-day" if period_interval == 1440 else "1-hour" if period_interval == 60 else f"{period_interval}-min"
-					print(f"  Fetching {interval_name} candles...")
-					
-					candles = fetch_candlesticks(
-						candidate_series, 
-						ticker, 
-						open_time, 
-						close_time, 
-						period_interval=period_interval,
-						extend_days_before=EXTEND_DAYS_BEFORE,
-						extend_days_after=EXTEND_DAYS_AFTER,
-						chunk_days=CHUNK_DAYS
-					)
-					if candles:
-						all_candlesticks.extend(candles)
-						print(f"  ✓ {interval_name}: {len(candles)} candles")
-				
-				if all_candlesticks:
-					# Remove duplicates based on end_period_ts (and period_interval to handle overlap)
-					seen_keys = set()
-					unique_candlesticks = []
-					for candle in all_candlesticks:
-						ts = candle.get("end_period_ts")
-						interval = candle.get("period_interval")
-						key = (ts, interval) if ts and interval else ts
-						if key and key not in seen_keys:
-							seen_keys.add(key)
-							unique_candlesticks.append(candle)
-					
-					# Sort by end_period_ts
-					unique_candlesticks.sort(key=lambda x: x.get("end_period_ts", 0))
-					
-					candlesticks = unique_candlesticks
-					successful_series = candidate_series
-					if candidate_series != event_ticker:
-						event_to_series_cache[event_ticker] = candidate_series
-					break
-			except Exception as e:
-				print(f"  ✗ Error processing {candidate_series}: {e}")
-				continue
-		
-		if candlesticks:
-			try:
-				# Store market with candlesticks in step_3
-				market_with_candlesticks = market.copy()
-				market_with_candlesticks["candlesticks"] = candlesticks
-				step_3_col.replace_one({"ticker": ticker}, market_with_candlesticks, upsert=True)
-				print(f"  ✓ Stored {len(candlesticks)} candlesticks")
-				success_count += 1
-			except Exception as e:
-				print(f"  ✗ Error storing to MongoDB: {e}")
-				error_count += 1
-		else:
-			print(f"  ✗ No candlesticks returned (tried {len(series_tickers_to_try)} series_ticker(s))")
-			error_count += 1
-		
-		print()  # Blank line between markets
-	
+	# Unique ticker index so the per-market upsert and $push updates hit an
+	# index instead of a collection scan
+	step_3_col.create_index("ticker", unique=True)
+
+	# Skip markets fully fetched in a previous run (pass --force to refetch).
+	# Only fetch_complete documents count: the incremental chunk writes mean a
+	# ticker can exist in step_33 with a partial history after an interrupted
+	# run, and those must be refetched (the first-chunk reset makes that safe).
+	if "--force" not in sys.argv:
+		done = set(step_3_col.distinct("ticker", {"fetch_complete": True}))
+		if done:
+			before = len(markets)
+			markets = [m for m in markets if m.get("ticker") not in done]
+			print(f"Skipping {before - len(markets)} markets already in step_33 ({len(markets)} to fetch)")
+			if not markets:
+				print("Nothing left to fetch. Exiting.")
+				return
+
+	counts = {"success": 0, "skip": 0, "error": 0}
+
+	# Event->series cache persisted across runs (entries expire after 7 days)
+	series_cache_col = db["series_cache"]
+	series_cache_col.create_index("ts", expireAfterSeconds=7 * 86400)
+	event_to_series_cache = {
+		d["_id"]: d["series_ticker"]
+		for d in series_cache_col.find()
+		if d.get("series_ticker")
+	}
+	print(f"Loaded {len(event_to_series_cache)} cached event->series mappings")
+
+	# Markets are independent and the work is network-bound, so fetch them
+	# concurrently with a bounded thread pool
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		# Resolve all unknown event->series mappings in one concurrent burst
+		prefetch_series_tickers(markets, event_to_series_cache, series_cache_col, executor)
+
+		futures = [
+			executor.submit(process_market, market, step_3_col, event_to_series_cache, series_cache_col)
+			for market in markets
+		]
+		for i, future in enumerate(as_completed(futures), 1):
+			status = future.result()
+			counts[status] += 1
+			print(f"[{i}/{len(markets)}] done")
+
 	print(f"\n{'='*60}")
 	print(f"Completed:")
-	print(f"  Success: {success_count}")
-	print(f"  Skipped: {skip_count}")
-	print(f"  Errors/No data: {error_count}")
+	print(f"  Success: {counts['success']}")
+	print(f"  Skipped: {counts['skip']}")
+	print(f"  Errors/No data: {counts['error']}")
 	print(f"  Total: {len(markets)}")
 	print(f"{'='*60}")
 
@@ -1,107 +1,184 @@
-from datetime import datetime
-from pymongo import MongoClient
+import numpy as np
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import OperationFailure
 
 
-def get_price_from_candle(candle):
-	"""Extract price from candlestick, preferring close over mean"""
-	price_obj = candle.get("price", {})
-	close_price = price_obj.get("close")
-	mean_price = price_obj.get("mean")
-	
-	if close_price is not None:
-		return close_price / 100.0  # Convert cents to dollars
-	elif mean_price is not None:
-		return mean_price / 100.0  # Convert cents to dollars
-	return None
-
+def _last_n_meet_threshold(ts, prices, threshold, min_duration_days):
+	"""True if the min_duration_days most recent prices are all >= threshold.
 
-def has_price_above_threshold_for_last_n_days(candlesticks, threshold=0.8, min_duration_days=7):
-	"""Check if the last N days of the market have price >= threshold.
-	
-	This checks specifically the final days of the market's lifetime, not any arbitrary period.
+	ts and prices are parallel NumPy arrays; threshold must be in the same unit
+	as prices (cents or dollars).
 	"""
-	if not candlesticks:
+	if ts.size < min_duration_days:
 		return False
-	
-	# Sort candlesticks by timestamp (oldest first)
-	sorted_candles = sorted(candlesticks, key=lambda x: x.get("end_period_ts", 0))
-	
-	# Filter out candles without valid timestamps or prices
-	valid_candles = []
-	for candle in sorted_candles:
-		end_ts = candle.get("end_period_ts")
-		if not end_ts:
-			continue
-		price = get_price_from_candle(candle)
-		if price is None:
+	# Select the min_duration_days candles with the largest timestamps in O(N)
+	# (argpartition instead of a full sort — their order doesn't matter for min())
+	if ts.size > min_duration_days:
+		top_idx = np.argpartition(ts, ts.size - min_duration_days)[-min_duration_days:]
+		last_n = prices[top_idx]
+	else:
+		last_n = prices
+	return bool(last_n.min() >= threshold)
+
+
+def filter_tail_end_server_side(step_3_col, threshold, min_duration_days):
+	"""Run the last-N-days filter as a MongoDB aggregation and $merge into step_4.
+
+	Sorting, slicing, the threshold test and the step_4 writes all execute
+	server-side, so matching documents never cross the wire at all. Requires
+	$sortArray/$merge (MongoDB 5.2+); raises OperationFailure on older servers.
+	"""
+	threshold_cents = threshold * 100
+	# Pre-baked _px_cents when present, else close-else-mean from the price object
+	px_expr = {"$ifNull": ["$$c._px_cents", {"$ifNull": ["$$c.price.close", "$$c.price.mean"]}]}
+	pipeline = [
+		{"$match": {"candlesticks.0": {"$exists": True}}},
+		# Keep only candles with a timestamp and a usable price (close, else mean)
+		{"$set": {"_valid": {"$filter": {
+			"input": "$candlesticks",
+			"as": "c",
+			"cond": {"$and": [
+				{"$gt": ["$$c.end_period_ts", None]},
+				{"$ne": [px_expr, None]},
+			]},
+		}}}},
+		# Require at least min_duration_days valid candles
+		{"$match": {f"_valid.{min_duration_days - 1}": {"$exists": True}}},
+		# Last N candles by timestamp
+		{"$set": {"_last": {"$slice": [
+			{"$sortArray": {"input": "$_valid", "sortBy": {"end_period_ts": 1}}},
+			-min_duration_days,
+		]}}},
+		# All of the last N candles must be at or above the threshold (in cents)
+		{"$match": {"$expr": {"$allElementsTrue": {"$map": {
+			"input": "$_last",
+			"as": "c",
+			"in": {"$gte": [px_expr, threshold_cents]},
+		}}}}},
+		# Materialize directly into step_4 without round-tripping through Python
+		{"$unset": ["_id", "_valid", "_last"]},
+		{"$merge": {
+			"into": "step_4",
+			"on": "ticker",
+			"whenMatched": "replace",
+			"whenNotMatched": "insert",
+		}},
+	]
+	step_3_col.aggregate(pipeline, allowDiskUse=True)
+
+
+def filter_tail_end_client_side(step_3_col, threshold, min_duration_days, total):
+	"""Fallback: stream normalized (ts, price) arrays and run the filter in Python.
+
+	The close-vs-mean selection and the cents->dollars division happen inside the
+	$project via $map/$ifNull/$divide, so Python only receives flat arrays of
+	timestamps and dollar prices per market.
+	"""
+	pipeline = [
+		{"$match": {"candlesticks.0": {"$exists": True}}},
+		{"$project": {
+			"_id": 0,
+			"ticker": 1,
+			"ts": {"$map": {
+				"input": "$candlesticks",
+				"as": "c",
+				"in": "$$c.end_period_ts",
+			}},
+			# _px_cents if pre-baked, else close-else-mean; null stays null
+			# ($divide passes it through)
+			"prices": {"$map": {
+				"input": "$candlesticks",
+				"as": "c",
+				"in": {"$divide": [
+					{"$ifNull": ["$$c._px_cents", {"$ifNull": ["$$c.price.close", "$$c.price.mean"]}]},
+					100,
+				]},
+			}},
+		}},
+	]
+	cursor = step_3_col.aggregate(pipeline, allowDiskUse=True, batchSize=1000)
+
+	passing_tickers = []
+
+	for i, market in enumerate(cursor, 1):
+		ticker = market.get("ticker", f"market_{i}")
+
+		# Drop entries missing a timestamp or price
+		pairs = [
+			(t, p)
+			for t, p in zip(market.get("ts", []), market.get("prices", []))
+			if t and p is not None
+		]
+		if len(pairs) < min_duration_days:
+			print(f"[{i}/{total}] ✗ {ticker}: does not meet criteria (last {min_duration_days} days)")
 			continue
-		valid_candles.append({
-			"timestamp": end_ts,
-			"price": price,
-			"datetime": datetime.fromtimestamp(end_ts)
-		})
-	
-	if not valid_candles:
-		return False
-	
-	# Get the last N candles (since we're using daily candles, this represents the last N days)
-	# We need at least min_duration_days candles to check
-	if len(valid_candles) < min_duration_days:
-		return False
-	
-	# Take the last min_duration_days candles
-	last_n_candles = valid_candles[-min_duration_days:]
-	
-	# Check if all of the last N candles are above threshold
-	for candle in last_n_candles:
-		if candle["price"] < threshold:
-			return False
-	
-	return True
+
+		ts = np.fromiter((t for t, _ in pairs), dtype=np.int64, count=len(pairs))
+		prices = np.fromiter((p for _, p in pairs), dtype=np.float64, count=len(pairs))
+
+		if _last_n_meet_threshold(ts, prices, threshold, min_duration_days):
+			passing_tickers.append(ticker)
+			print(f"[{i}/{total}] ✓ {ticker}: price >= {threshold*100:.0f}% for last {min_duration_days} days")
+		else:
+			print(f"[{i}/{total}] ✗ {ticker}: does not meet criteria (last {min_duration_days} days)")
+
+	return passing_tickers
 
 
 def main():
 	client = MongoClient("mongodb://localhost:27017")
 	db = client["tail-end-analysis"]
 	
-	# Read all markets from step_3
 	step_3_col = db["step_3"]
-	markets = list(step_3_col.find())
-	print(f"Found {len(markets)} markets in step_3")
-	
-	if not markets:
+	total = step_3_col.count_documents({})
+	print(f"Found {total} markets in step_3")
+
+	if total == 0:
 		print("No markets found in step_3. Exiting.")
 		return
-	
+
 	# Filter markets: price >= threshold for the last N days
 	THRESHOLD = 0.94  # 95%
 	MIN_DURATION_DAYS = 7  # Last 7 days
-	
-	filtered_markets = []
-	
-	for i, market in enumerate(markets, 1):
-		ticker = market.get("ticker", f"market_{i}")
-		candlesticks = market.get("candlesticks", [])
-		
-		if not candlesticks:
-			continue
-		
-		if has_price_above_threshold_for_last_n_days(candlesticks, threshold=THRESHOLD, min_duration_days=MIN_DURATION_DAYS):
-			filtered_markets.append(market)
-			print(f"[{i}/{len(markets)}] ✓ {ticker}: price >= {THRESHOLD*100:.0f}% for last {MIN_DURATION_DAYS} days")
-		else:
-			print(f"[{i}/{len(markets)}] ✗ {ticker}: does not meet criteria (last {MIN_DURATION_DAYS} days)")
-	
-	# Store filtered markets in step_4
+
+	# Unique ticker index so $merge / upserts are index-backed
 	step_4_col = db["step_4"]
-	for market in filtered_markets:
-		ticker = market.get("ticker")
-		step_4_col.replace_one({"ticker": ticker}, market, upsert=True)
-	
+	step_4_col.create_index("ticker", unique=True)
+
+	try:
+		print("Filtering server-side via aggregation (merged into step_4)...")
+		filter_tail_end_server_side(step_3_col, THRESHOLD, MIN_DURATION_DAYS)
+		# $merge only inserts/replaces — it never deletes — so on re-runs the
+		# collection can still hold markets from earlier runs that no longer
+		# pass the filter. Report the collection total as exactly that.
+		stored = step_4_col.count_documents({})
+		print(f"\nCompleted:")
+		print(f"  Total markets in step_3: {total}")
+		print(f"  Criteria: price >= {THRESHOLD*100:.0f}% for last {MIN_DURATION_DAYS} days")
+		print(f"  step_4 collection now holds {stored} markets (may include matches from earlier runs)")
+		return
+	except OperationFailure as e:
+		# $sortArray/$merge require MongoDB 5.2+; fall back to the client-side filter
+		print(f"Aggregation not supported ({e}), filtering client-side...")
+		passing_tickers = filter_tail_end_client_side(step_3_col, THRESHOLD, MIN_DURATION_DAYS, total)
+
+		# Store filtered markets in step_4 (bulk upserts, one round-trip per batch).
+		# Full documents are fetched only for the markets that passed the filter.
+		batch_size = 1000
+		for start in range(0, len(passing_tickers), batch_size):
+			tickers = passing_tickers[start:start + batch_size]
+			ops = [
+				ReplaceOne({"ticker": m.get("ticker")}, m, upsert=True)
+				for m in step_3_col.find({"ticker": {"$in": tickers}}).batch_size(1000)
+			]
+			if ops:
+				step_4_col.bulk_write(ops, ordered=False)
+		stored = len(passing_tickers)
+
 	print(f"\nCompleted:")
-	print(f"  Total markets in step_3: {len(markets)}")
-	print(f"  Markets meeting criteria (price >= {THRESHOLD*100:.0f}% for last {MIN_DURATION_DAYS} days): {len(filtered_markets)}")
-	print(f"  Stored {len(filtered_markets)} markets in step_4 collection")
+	print(f"  Total markets in step_3: {total}")
+	print(f"  Markets meeting criteria (price >= {THRESHOLD*100:.0f}% for last {MIN_DURATION_DAYS} days): {stored}")
+	print(f"  Stored {stored} markets in step_4 collection")
 
 
 if __name__ == "__main__":
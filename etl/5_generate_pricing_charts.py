@@ -1,82 +1,88 @@
-from datetime import datetime
+import numpy as np
 from pymongo import MongoClient
+import matplotlib
+matplotlib.use("Agg")  # Headless raster backend; safe in pool workers
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import os
+from multiprocessing import Pool
 
 
-def plot_market_price(market, save_path=None):
-	"""Plot price over time for a single market"""
+def candles_to_soa(candlesticks):
+	"""Convert a candlestick list into a dict of parallel NumPy arrays (SoA).
+
+	One pass over the dicts; NaN marks missing prices and 0 marks a missing
+	timestamp. Everything downstream (filters, plotting) works on these
+	contiguous arrays instead of re-walking the nested candle dicts.
+	"""
+	n = len(candlesticks)
+	ts = np.empty(n, dtype=np.int64)
+	close = np.empty(n, dtype=np.float64)
+	yes_ask = np.empty(n, dtype=np.float64)
+	yes_bid = np.empty(n, dtype=np.float64)
+
+	def _f(value):
+		return np.nan if value is None else value
+
+	for i, candle in enumerate(candlesticks):
+		ts[i] = candle.get("end_period_ts") or 0
+		close[i] = _f(candle.get("price", {}).get("close"))
+		yes_ask[i] = _f(candle.get("yes_ask", {}).get("close"))
+		yes_bid[i] = _f(candle.get("yes_bid", {}).get("close"))
+
+	return {"ts": ts, "close": close, "yes_ask": yes_ask, "yes_bid": yes_bid}
+
+
+def plot_market_price(market, fig, ax, save_path=None):
+	"""Plot price over time for a single market.
+
+	fig/ax are created once per process and reused; the axes are cleared here
+	instead of rebuilding the figure (renderer, font cache) per market.
+	Returns True if a plot was produced, False if the market was skipped.
+	"""
 	ticker = market.get("ticker", "Unknown")
 	title = market.get("title", ticker)
 	candlesticks = market.get("candlesticks", [])
 	
 	if not candlesticks:
 		print(f"No candlesticks found for {ticker}")
-		return
+		return False
 	
-	# Extract timestamps and prices
-	times = []
-	prices_close = []
-	yes_ask_close = []
-	yes_bid_close = []
-	
-	for candle in candlesticks:
-		end_ts = candle.get("end_period_ts")
-		if not end_ts:
-			continue
-		
-		# Convert timestamp to datetime
-		dt = datetime.fromtimestamp(end_ts)
-		times.append(dt)
-		
-		# Extract close price
-		price_obj = candle.get("price", {})
-		close_price = price_obj.get("close")
-		if close_price is not None:
-			prices_close.append(close_price / 100.0)  # Convert cents to dollars
-		else:
-			prices_close.append(None)
-		
-		# Extract yes_ask close
-		yes_ask_obj = candle.get("yes_ask", {})
-		yes_ask_close_val = yes_ask_obj.get("close")
-		if yes_ask_close_val is not None:
-			yes_ask_close.append(yes_ask_close_val / 100.0)  # Convert cents to dollars
-		else:
-			yes_ask_close.append(None)
-		
-		# Extract yes_bid close
-		yes_bid_obj = candle.get("yes_bid", {})
-		yes_bid_close_val = yes_bid_obj.get("close")
-		if yes_bid_close_val is not None:
-			yes_bid_close.append(yes_bid_close_val / 100.0)  # Convert cents to dollars
-		else:
-			yes_bid_close.append(None)
-	
-	if not times:
+	soa = candles_to_soa(candlesticks)
+	ts = soa["ts"]
+	prices_close = soa["close"]
+	yes_ask_close = soa["yes_ask"]
+	yes_bid_close = soa["yes_bid"]
+
+	has_ts = ts > 0
+	if not has_ts.any():
 		print(f"No valid timestamps found for {ticker}")
-		return
-	
-	# Create the plot
-	fig, ax = plt.subplots(figsize=(12, 6))
+		return False
+
+	# Convert cents to dollars
+	prices_close /= 100.0
+	yes_ask_close /= 100.0
+	yes_bid_close /= 100.0
+
+	# One vectorized conversion; matplotlib consumes datetime64[s] directly
+	times = ts.astype("datetime64[s]")
+
+	ax.clear()
 	
 	# Plot close prices
-	valid_close = [(t, p) for t, p in zip(times, prices_close) if p is not None]
-	if valid_close:
-		close_times, close_prices = zip(*valid_close)
-		ax.plot(close_times, close_prices, label="Close Price", linewidth=1.5, alpha=0.8, color='steelblue')
+	mask_close = has_ts & ~np.isnan(prices_close)
+	if mask_close.any():
+		ax.plot(times[mask_close], prices_close[mask_close], label="Close Price", linewidth=1.5, alpha=0.8, color='steelblue', rasterized=True)
 	
 	# Plot yes_ask close
-	valid_yes_ask = [(t, p) for t, p in zip(times, yes_ask_close) if p is not None]
-	if valid_yes_ask:
-		yes_ask_times, yes_ask_prices = zip(*valid_yes_ask)
-		ax.plot(yes_ask_times, yes_ask_prices, label="Yes Ask Close", linewidth=1.5, alpha=0.8, color='green', linestyle='--')
+	mask_yes_ask = has_ts & ~np.isnan(yes_ask_close)
+	if mask_yes_ask.any():
+		ax.plot(times[mask_yes_ask], yes_ask_close[mask_yes_ask], label="Yes Ask Close", linewidth=1.5, alpha=0.8, color='green', linestyle='--', rasterized=True)
 	
 	# Plot yes_bid close
-	valid_yes_bid = [(t, p) for t, p in zip(times, yes_bid_close) if p is not None]
-	if valid_yes_bid:
-		yes_bid_times, yes_bid_prices = zip(*valid_yes_bid)
-		ax.plot(yes_bid_times, yes_bid_prices, label="Yes Bid Close", linewidth=1.5, alpha=0.8, color='red', linestyle=':')
+	mask_yes_bid = has_ts & ~np.isnan(yes_bid_close)
+	if mask_yes_bid.any():
+		ax.plot(times[mask_yes_bid], yes_bid_close[mask_yes_bid], label="Yes Bid Close", linewidth=1.5, alpha=0.8, color='red', linestyle=':', rasterized=True)
 	
 	ax.set_xlabel("Time", fontsize=12)
 	ax.set_ylabel("Price (USD)", fontsize=12)
@@ -89,46 +95,106 @@ def plot_market_price(market, save_path=None):
 	# Use AutoDateLocator to automatically pick appropriate intervals, or show more dates
 	ax.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=15))
 	ax.xaxis.set_minor_locator(mdates.DayLocator(interval=1))
-	plt.xticks(rotation=45)
+	plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
 	
-	plt.tight_layout()
+	fig.tight_layout()
 	
 	if save_path:
-		plt.savefig(save_path, dpi=150, bbox_inches="tight")
+		# Lower DPI and light PNG compression: zlib level 1 encodes several
+		# times faster than the default for marginally larger files
+		fig.savefig(save_path, dpi=100, pil_kwargs={"compress_level": 1})
 		print(f"Saved plot to {save_path}")
 	else:
 		plt.show()
-	
-	plt.close()
+	return True
+
+
+# Fields the charts actually use; shared by the worker partition reads
+_PROJECTION = {
+	"_id": 0,
+	"ticker": 1,
+	"title": 1,
+	"candlesticks.end_period_ts": 1,
+	"candlesticks.price.close": 1,
+	"candlesticks.yes_ask.close": 1,
+	"candlesticks.yes_bid.close": 1,
+}
+
+_PLOTS_DIR = "plots"
+
+# How many tickers one pool task covers; small enough to balance load,
+# large enough to amortize the query round-trip
+_PARTITION_SIZE = 50
+
+# Per-worker reusable figure for parallel plot rendering
+_worker_fig = None
+_worker_ax = None
+_worker_plots = 0
+
+
+def _init_plot_worker():
+	"""Build each worker's figure once; rendering then only clears the axes."""
+	global _worker_fig, _worker_ax
+	_worker_fig, _worker_ax = plt.subplots(figsize=(12, 6))
+
+
+def _render_partition(tickers):
+	"""Pool worker: stream this partition's markets from Mongo and render them.
+
+	Each worker reads its own slice of step_4 directly, so the large
+	candlestick arrays never get pickled from the parent process.
+	"""
+	global _worker_ax, _worker_plots
+	client = MongoClient("mongodb://localhost:27017")
+	col = client["tail-end-analysis"]["step_4"]
+	rendered = 0
+	for market in col.find({"ticker": {"$in": tickers}}, _PROJECTION).batch_size(50):
+		ticker = market.get("ticker", "unknown")
+		save_path = os.path.join(_PLOTS_DIR, f"{ticker.replace('/', '_')}.png")
+		# Only count markets that actually produced a PNG; skipped ones
+		# (no candlesticks, no valid timestamps) print their own reason
+		if plot_market_price(market, _worker_fig, _worker_ax, save_path=save_path):
+			rendered += 1
+		_worker_plots += 1
+		# Rebuild the axes every so often to release accumulated artist references
+		if _worker_plots % 100 == 0:
+			_worker_fig.clf()
+			_worker_ax = _worker_fig.add_subplot(111)
+	client.close()
+	return rendered
 
 
 def main():
 	client = MongoClient("mongodb://localhost:27017")
 	db = client["tail-end-analysis"]
 	
-	# Read all markets from step_4
+	# Only the ticker list is read in the parent; workers stream their own
+	# partitions so market documents are never pickled across processes
 	step_4_col = db["step_4"]
-	markets = list(step_4_col.find())
-	print(f"Found {len(markets)} markets in step_4")
+	tickers = step_4_col.distinct("ticker")
+	print(f"Found {len(tickers)} markets in step_4")
 	
-	if not markets:
+	if not tickers:
 		print("No markets found in step_4. Exiting.")
 		return
 	
 	# Create plots directory
-	import os
-	plots_dir = "plots"
-	os.makedirs(plots_dir, exist_ok=True)
-	
-	# Plot each market
-	for i, market in enumerate(markets, 1):
-		ticker = market.get("ticker", f"market_{i}")
-		print(f"[{i}/{len(markets)}] Plotting {ticker}...")
-		
-		save_path = os.path.join(plots_dir, f"{ticker.replace('/', '_')}.png")
-		plot_market_price(market, save_path=save_path)
-	
-	print(f"\nCompleted: Generated {len(markets)} plots in '{plots_dir}' directory")
+	os.makedirs(_PLOTS_DIR, exist_ok=True)
+	
+	# Rendering is CPU-bound in matplotlib and independent per market, so fan
+	# ticker partitions out across cores
+	partitions = [
+		tickers[start:start + _PARTITION_SIZE]
+		for start in range(0, len(tickers), _PARTITION_SIZE)
+	]
+	rendered = 0
+	with Pool(initializer=_init_plot_worker) as pool:
+		for n in pool.imap_unordered(_render_partition, partitions):
+			rendered += n
+			print(f"[{rendered}/{len(tickers)}] plots rendered", end="\r")
+	print()
+	
+	print(f"\nCompleted: Generated {rendered} plots in '{_PLOTS_DIR}' directory")
 
 
 if __name__ == "__main__":
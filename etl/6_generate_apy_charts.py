@@ -1,8 +1,86 @@
 from datetime import datetime
+import numpy as np
+import pandas as pd
 from pymongo import MongoClient
+import matplotlib
+matplotlib.use("Agg")  # Headless raster backend; no GUI event loop per figure
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import os
+from multiprocessing import Pool
+
+try:
+	from numba import njit
+except ImportError:  # numba is optional; the NumPy kernel below is the fallback
+	njit = None
+
+
+def _apy_kernel_numpy(ts, price, last_ts):
+	"""Per-candle APY; NaN where the candle has no timestamp, price or days left."""
+	days_remaining = (last_ts - ts) // 86400
+	out = np.full(ts.size, np.nan, dtype=np.float64)
+	valid = (ts > 0) & (price > 0) & (days_remaining > 0)
+	# One division instead of two: ((1/p) - 1) * (365/d) * 100 == (1-p)*36500/(p*d)
+	out[valid] = (1.0 - price[valid]) * 36500.0 / (price[valid] * days_remaining[valid])
+	return out
+
+
+if njit is not None:
+	# Eagerly compiled (explicit signature) so the JIT cost is paid once at
+	# import instead of inside the per-market loop
+	@njit("float64[:](int64[:], float64[:], int64)", cache=True, fastmath=True)
+	def _apy_kernel(ts, price, last_ts):
+		out = np.empty(ts.size, dtype=np.float64)
+		for i in range(ts.size):
+			days = (last_ts - ts[i]) // 86400
+			if ts[i] > 0 and price[i] > 0.0 and days > 0:
+				out[i] = (1.0 - price[i]) * 36500.0 / (price[i] * days)
+			else:
+				out[i] = np.nan
+		return out
+else:
+	_apy_kernel = _apy_kernel_numpy
+
+
+# Downsample plotted series longer than this to roughly _LTTB_TARGET points;
+# at daily resolution most markets stay below the threshold untouched
+_LTTB_THRESHOLD = 2500
+_LTTB_TARGET = 2000
+
+
+def lttb_select(x, y, n_out):
+	"""Largest-Triangle-Three-Buckets: pick n_out visually representative indices.
+
+	Classic LTTB: keep the endpoints, split the interior into n_out - 2 buckets
+	and from each bucket keep the point forming the largest triangle with the
+	previously kept point and the next bucket's average.
+	"""
+	n = x.size
+	if n_out >= n or n_out < 3:
+		return np.arange(n)
+	idx = np.empty(n_out, dtype=np.intp)
+	idx[0] = 0
+	idx[n_out - 1] = n - 1
+	bounds = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+	a = 0
+	for i in range(n_out - 2):
+		lo, hi = bounds[i], bounds[i + 1]
+		nhi = bounds[i + 2] if i + 2 < n_out - 1 else n
+		avg_x = x[hi:nhi].mean()
+		avg_y = y[hi:nhi].mean()
+		area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+		a = lo + int(area.argmax())
+		idx[i + 1] = a
+	return idx
+
+
+def _downsample_for_plot(times, values):
+	"""LTTB-downsample a (times, values) series if it is large enough to matter."""
+	values = np.asarray(values, dtype=np.float64)
+	if values.size <= _LTTB_THRESHOLD:
+		return times, values
+	idx = lttb_select(times.astype(np.int64), values, _LTTB_TARGET)
+	return times[idx], values[idx]
 
 
 def get_price_from_candle(candle):
@@ -18,157 +96,145 @@ def get_price_from_candle(candle):
 	return None
 
 
+def extract_market_series(market):
+	"""Extract all price series from a market's candlesticks in one pass.
+
+	Returns a dict of NumPy arrays {ts, close, yes_ask, yes_bid} sorted once by
+	timestamp, prices in dollars with NaN for missing values, or None if the
+	market has no candlesticks. Every APY/plot consumer derives its series from
+	this struct instead of re-scanning (and re-sorting) the candle dicts.
+
+	The result is memoized on the market dict, so repeated calls for the same
+	market (range print, plot sanity check, per-price-type APY) extract once.
+	"""
+	cached = market.get("_series")
+	if cached is not None:
+		return cached
+
+	candlesticks = market.get("candlesticks", [])
+	if not candlesticks:
+		return None
+
+	def _f(value):
+		return np.nan if value is None else value
+
+	def _gen():
+		for candle in candlesticks:
+			yield (
+				candle.get("end_period_ts") or 0,
+				_f((candle.get("price") or {}).get("close")),
+				_f((candle.get("yes_ask") or {}).get("close")),
+				_f((candle.get("yes_bid") or {}).get("close")),
+			)
+
+	# One fromiter pass into a single contiguous structured buffer instead of
+	# four separate Python lists of boxed floats
+	dt = np.dtype([("ts", "i8"), ("close", "f8"), ("yes_ask", "f8"), ("yes_bid", "f8")])
+	arr = np.fromiter(_gen(), dtype=dt, count=len(candlesticks))
+
+	arr = arr[np.argsort(arr["ts"], kind="stable")]
+	series = {
+		"ts": arr["ts"],
+		"close": arr["close"] / 100.0,  # Convert cents to dollars
+		"yes_ask": arr["yes_ask"] / 100.0,
+		"yes_bid": arr["yes_bid"] / 100.0,
+	}
+	market["_series"] = series
+	return series
+
+
 def calculate_apy_over_time(market, price_type='close'):
 	"""Calculate APY over time assuming market resolves to 1.00 USD
 	price_type can be 'close', 'yes_ask', or 'yes_bid'
+	Vectorized: works on the shared extract_market_series arrays, so the APY
+	formula runs as array ops instead of a per-candle Python loop.
 	"""
-	candlesticks = market.get("candlesticks", [])
-	
-	if not candlesticks:
+	if price_type not in ('close', 'yes_ask', 'yes_bid'):
 		return None, None
-	
-	# Sort candlesticks by timestamp
-	sorted_candles = sorted(candlesticks, key=lambda x: x.get("end_period_ts", 0))
-	
-	# Get last date (resolution date)
-	last_candle = sorted_candles[-1]
-	last_ts = last_candle.get("end_period_ts")
-	if not last_ts:
+
+	# Memoized per market: main() and the plotting helpers request the same
+	# price types repeatedly
+	cache = market.setdefault("_apy_cache", {})
+	if price_type in cache:
+		return cache[price_type]
+
+	series = extract_market_series(market)
+	if series is None:
+		cache[price_type] = (None, None)
 		return None, None
-	
-	last_date = datetime.fromtimestamp(last_ts)
-	
-	# Calculate APY for each point in time
-	times = []
-	apy_values = []
-	
-	for candle in sorted_candles:
-		end_ts = candle.get("end_period_ts")
-		if not end_ts:
-			continue
-		
-		current_date = datetime.fromtimestamp(end_ts)
-		
-		# Get price based on price_type
-		if price_type == 'close':
-			price_obj = candle.get("price", {})
-			price_val = price_obj.get("close")
-		elif price_type == 'yes_ask':
-			yes_ask_obj = candle.get("yes_ask", {})
-			price_val = yes_ask_obj.get("close")
-		elif price_type == 'yes_bid':
-			yes_bid_obj = candle.get("yes_bid", {})
-			price_val = yes_bid_obj.get("close")
-		else:
-			continue
-		
-		if price_val is None or price_val <= 0:
-			continue
-		
-		price = price_val / 100.0  # Convert cents to dollars
-		
-		# Calculate days remaining until resolution
-		days_remaining = (last_date - current_date).days
-		if days_remaining <= 0:
-			# Skip if we're at or past the resolution date
-			continue
-		
-		# Calculate APY: ((Final Price / Current Price) - 1) * (365 / days_remaining) * 100
-		# Assuming final price is 1.00 USD when resolved
-		final_price = 1.00
-		apy = ((final_price / price) - 1) * (365 / days_remaining) * 100
-		
-		times.append(current_date)
-		apy_values.append(apy)
-	
-	if not times:
+
+	ts = series["ts"]
+	price = series[price_type]
+
+	# Last timestamp is the (assumed) resolution date
+	last_ts = int(ts[-1])
+
+	# APY: ((Final Price / Current Price) - 1) * (365 / days_remaining) * 100
+	# Assuming final price is 1.00 USD when resolved; days remaining are whole
+	# days, floored like datetime subtraction
+	apy = _apy_kernel(ts, price, last_ts) if last_ts else None
+	valid = ~np.isnan(apy) if apy is not None else None
+	if valid is None or not valid.any():
+		cache[price_type] = (None, None)
 		return None, None
-	
-	return times, apy_values
+
+	# One vectorized conversion at the plotting boundary; matplotlib/pandas
+	# consume datetime64[s] directly, so no per-candle datetime objects
+	times = ts[valid].astype("datetime64[s]")
+	cache[price_type] = (times, apy[valid].tolist())
+	return cache[price_type]
 
 
-def plot_apy(market, save_path=None):
-	"""Plot price and APY over time for a single market - combined plot"""
+def plot_apy(market, fig, ax1, ax2, save_path=None):
+	"""Plot price and APY over time for a single market - combined plot.
+
+	fig/ax1/ax2 are created once by the caller and reused across markets;
+	the axes are cleared here, which is much cheaper than rebuilding the
+	figure (axes, tickers, font caches) per market.
+	"""
 	ticker = market.get("ticker", "Unknown")
 	title = market.get("title", ticker)
-	candlesticks = market.get("candlesticks", [])
-	
-	if not candlesticks:
+
+	# One extraction pass shared by all three price series
+	series = extract_market_series(market)
+	if series is None:
 		print(f"No candlesticks found for {ticker}")
 		return
-	
-	# Calculate APY over time (will recalculate for all three types later, but check if close works)
-	apy_times, apy_values = calculate_apy_over_time(market, price_type='close')
-	
-	if apy_times is None:
+
+	# APY for the two plotted price types (memoized per market)
+	apy_times_close, apy_values_close = calculate_apy_over_time(market, price_type='close')
+	apy_times_ask, apy_values_ask = calculate_apy_over_time(market, price_type='yes_ask')
+
+	if apy_times_close is None:
 		print(f"Could not calculate APY for {ticker}")
 		return
-	
-	# Extract price data (close, yes_ask, yes_bid)
-	price_times = []
-	prices_close = []
-	yes_ask_close = []
-	yes_bid_close = []
-	
-	for candle in candlesticks:
-		end_ts = candle.get("end_period_ts")
-		if not end_ts:
-			continue
-		
-		# Convert timestamp to datetime
-		dt = datetime.fromtimestamp(end_ts)
-		price_times.append(dt)
-		
-		# Extract close price
-		price_obj = candle.get("price", {})
-		close_price = price_obj.get("close")
-		if close_price is not None:
-			prices_close.append(close_price / 100.0)  # Convert cents to dollars
-		else:
-			prices_close.append(None)
-		
-		# Extract yes_ask close
-		yes_ask_obj = candle.get("yes_ask", {})
-		yes_ask_close_val = yes_ask_obj.get("close")
-		if yes_ask_close_val is not None:
-			yes_ask_close.append(yes_ask_close_val / 100.0)  # Convert cents to dollars
-		else:
-			yes_ask_close.append(None)
-		
-		# Extract yes_bid close
-		yes_bid_obj = candle.get("yes_bid", {})
-		yes_bid_close_val = yes_bid_obj.get("close")
-		if yes_bid_close_val is not None:
-			yes_bid_close.append(yes_bid_close_val / 100.0)  # Convert cents to dollars
-		else:
-			yes_bid_close.append(None)
-	
-	if not price_times:
+
+	ts = series["ts"]
+	has_ts = ts > 0
+	if not has_ts.any():
 		print(f"No valid timestamps found for {ticker}")
 		return
-	
-	# Calculate APY for close and ask price types
-	apy_times_close, apy_values_close = calculate_apy_over_time(market, price_type='close')
-	apy_times_ask, apy_values_ask = calculate_apy_over_time(market, price_type='yes_ask')
-	
-	# Create figure with two subplots stacked vertically
-	fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10), sharex=True)
-	
+
+	price_times = ts.astype("datetime64[s]")
+
+	ax1.clear()
+	ax2.clear()
+
 	# Top subplot: Price over time (3 lines)
-	valid_close = [(t, p) for t, p in zip(price_times, prices_close) if p is not None]
-	if valid_close:
-		close_times, close_prices = zip(*valid_close)
-		ax1.plot(close_times, close_prices, label="Close Price", linewidth=1.5, alpha=0.8, color='steelblue')
-	
-	valid_yes_ask = [(t, p) for t, p in zip(price_times, yes_ask_close) if p is not None]
-	if valid_yes_ask:
-		yes_ask_times, yes_ask_prices = zip(*valid_yes_ask)
-		ax1.plot(yes_ask_times, yes_ask_prices, label="Yes Ask Close", linewidth=1.5, alpha=0.8, color='green', linestyle='--')
-	
-	valid_yes_bid = [(t, p) for t, p in zip(price_times, yes_bid_close) if p is not None]
-	if valid_yes_bid:
-		yes_bid_times, yes_bid_prices = zip(*valid_yes_bid)
-		ax1.plot(yes_bid_times, yes_bid_prices, label="Yes Bid Close", linewidth=1.5, alpha=0.8, color='red', linestyle=':')
+	mask_close = has_ts & ~np.isnan(series["close"])
+	if mask_close.any():
+		xs, ys = _downsample_for_plot(price_times[mask_close], series["close"][mask_close])
+		ax1.plot(xs, ys, label="Close Price", linewidth=1.5, alpha=0.8, color='steelblue', rasterized=True)
+
+	mask_yes_ask = has_ts & ~np.isnan(series["yes_ask"])
+	if mask_yes_ask.any():
+		xs, ys = _downsample_for_plot(price_times[mask_yes_ask], series["yes_ask"][mask_yes_ask])
+		ax1.plot(xs, ys, label="Yes Ask Close", linewidth=1.5, alpha=0.8, color='green', linestyle='--', rasterized=True)
+
+	mask_yes_bid = has_ts & ~np.isnan(series["yes_bid"])
+	if mask_yes_bid.any():
+		xs, ys = _downsample_for_plot(price_times[mask_yes_bid], series["yes_bid"][mask_yes_bid])
+		ax1.plot(xs, ys, label="Yes Bid Close", linewidth=1.5, alpha=0.8, color='red', linestyle=':', rasterized=True)
 	
 	ax1.set_ylabel("Price (USD)", fontsize=12)
 	ax1.set_title(f"{title}\n({ticker})", fontsize=14, fontweight="bold")
@@ -176,11 +242,13 @@ def plot_apy(market, save_path=None):
 	ax1.legend()
 	
 	# Bottom subplot: APY over time (2 lines)
-	if apy_times_close and apy_values_close:
-		ax2.plot(apy_times_close, apy_values_close, label="APY (Close)", linewidth=1.5, alpha=0.8, color='steelblue')
+	if apy_times_close is not None and apy_values_close:
+		xs, ys = _downsample_for_plot(apy_times_close, apy_values_close)
+		ax2.plot(xs, ys, label="APY (Close)", linewidth=1.5, alpha=0.8, color='steelblue', rasterized=True)
 	
-	if apy_times_ask and apy_values_ask:
-		ax2.plot(apy_times_ask, apy_values_ask, label="APY (Yes Ask)", linewidth=1.5, alpha=0.8, color='green', linestyle='--')
+	if apy_times_ask is not None and apy_values_ask:
+		xs, ys = _downsample_for_plot(apy_times_ask, apy_values_ask)
+		ax2.plot(xs, ys, label="APY (Yes Ask)", linewidth=1.5, alpha=0.8, color='green', linestyle='--', rasterized=True)
 	
 	ax2.legend()
 	
@@ -197,15 +265,13 @@ def plot_apy(market, save_path=None):
 	# Add a horizontal line at 0% APY for reference
 	ax2.axhline(y=0, color='black', linestyle='--', linewidth=0.5, alpha=0.5)
 	
-	plt.tight_layout()
-	
 	if save_path:
-		plt.savefig(save_path, dpi=150, bbox_inches="tight")
+		# constrained_layout already handled spacing; skipping bbox_inches
+		# avoids an extra layout/render pass per PNG
+		fig.savefig(save_path, dpi=100)
 		print(f"Saved plot to {save_path}")
 	else:
 		plt.show()
-	
-	plt.close()
 
 
 def plot_all_apy_summary(markets, save_path=None):
@@ -213,52 +279,31 @@ def plot_all_apy_summary(markets, save_path=None):
 	fig, ax = plt.subplots(figsize=(14, 8))
 	
 	# Collect all market APY data (using ask price)
-	market_data = []
+	series_list = []
 	valid_count = 0
 	for market in markets:
 		ticker = market.get("ticker", "Unknown")
 		times, apy_values = calculate_apy_over_time(market, price_type='yes_ask')
-		
+
 		if times is not None and apy_values is not None:
 			ax.plot(times, apy_values, alpha=0.5, linewidth=1, label=ticker)
-			market_data.append((times, apy_values))
+			series_list.append(pd.Series(apy_values, index=pd.DatetimeIndex(times), name=ticker))
 			valid_count += 1
-	
+
 	if valid_count == 0:
 		print("No valid APY data to plot")
 		return
-	
-	# Calculate lowest market APY at each time point
-	# Collect all unique timestamps
-	all_timestamps = set()
-	for times, _ in market_data:
-		all_timestamps.update(times)
-	
-	all_timestamps = sorted(all_timestamps)
-	
-	# For each timestamp, collect APY values from all markets that have data at that time
-	lowest_market_times = []
-	lowest_market_values = []
-	
-	for ts in all_timestamps:
-		apy_at_ts = []
-		for times, apy_values in market_data:
-			# Find the closest timestamp in this market's data
-			if ts in times:
-				idx = times.index(ts)
-				apy_at_ts.append(apy_values[idx])
-		
-		if len(apy_at_ts) >= 1:
-			# Take the lowest value
-			lowest_apy = min(apy_at_ts)
-			lowest_market_times.append(ts)
-			lowest_market_values.append(lowest_apy)
-	
+
+	# Lowest market APY at each time point: align all markets on one time axis
+	# and take the column-wise minimum (NaN where a market has no data)
+	wide = pd.concat(series_list, axis=1)
+	lowest = wide.min(axis=1).dropna()
+
 	# Plot the lowest market line (bolder)
 	lowest_line = None
-	if lowest_market_times and lowest_market_values:
-		lowest_line, = ax.plot(lowest_market_times, lowest_market_values, 
-				label="Lowest Market", 
+	if not lowest.empty:
+		lowest_line, = ax.plot(lowest.index, lowest.values,
+				label="Lowest Market",
 				linewidth=3, alpha=0.9, color='darkred', linestyle='-')
 	
 	ax.set_xlabel("Time", fontsize=12)
@@ -296,13 +341,39 @@ def plot_all_apy_summary(markets, save_path=None):
 	plt.close()
 
 
+# Per-worker reusable figure for parallel plot rendering
+_worker_fig = None
+_worker_axes = None
+
+
+def _init_plot_worker():
+	"""Build each worker's figure once; rendering then only clears axes."""
+	global _worker_fig, _worker_axes
+	_worker_fig, _worker_axes = plt.subplots(2, 1, figsize=(12, 10), sharex=True, constrained_layout=True)
+
+
+def _plot_market(job):
+	market, save_path = job
+	ax1, ax2 = _worker_axes
+	plot_apy(market, _worker_fig, ax1, ax2, save_path=save_path)
+
+
 def main():
 	client = MongoClient("mongodb://localhost:27017")
 	db = client["tail-end-analysis"]
 	
-	# Read all markets from step_4
+	# Read all markets from step_4, projecting only the fields the charts use
 	step_4_col = db["step_4"]
-	markets = list(step_4_col.find())
+	projection = {
+		"_id": 0,
+		"ticker": 1,
+		"title": 1,
+		"candlesticks.end_period_ts": 1,
+		"candlesticks.price.close": 1,
+		"candlesticks.yes_ask.close": 1,
+		"candlesticks.yes_bid.close": 1,
+	}
+	markets = list(step_4_col.find({}, projection))
 	print(f"Found {len(markets)} markets in step_4")
 	
 	if not markets:
@@ -313,8 +384,9 @@ def main():
 	plots_dir = os.path.join("plots", "apy")
 	os.makedirs(plots_dir, exist_ok=True)
 	
-	# Plot APY for each market
+	# First pass: compute/validate APY (cheap, also warms the per-market cache)
 	valid_markets = []
+	jobs = []
 	for i, market in enumerate(markets, 1):
 		ticker = market.get("ticker", f"market_{i}")
 		times, apy_values = calculate_apy_over_time(market, price_type='close')
@@ -330,7 +402,14 @@ def main():
 			print(f"[{i}/{len(markets)}] ✓ {ticker}: APY range (close) = {min_apy:.2f}% to {max_apy:.2f}%")
 		
 		save_path = os.path.join(plots_dir, f"{ticker.replace('/', '_')}_apy.png")
-		plot_apy(market, save_path=save_path)
+		jobs.append((market, save_path))
+
+	# Rendering is CPU-bound in matplotlib and independent per market, so
+	# fan it out across cores; each worker owns one reusable figure
+	if jobs:
+		with Pool(initializer=_init_plot_worker) as pool:
+			for _ in pool.imap_unordered(_plot_market, jobs, chunksize=4):
+				pass
 	
 	# Create summary plot
 	if valid_markets:
@@ -1,3 +1,4 @@
+import functools
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -7,47 +8,72 @@ from tqdm import tqdm
 
 # ---------- Helper Functions ----------
 
+@functools.lru_cache(maxsize=None)
 def parse_iso(ts_str):
+    """Parse an ISO timestamp; memoized since the same close_time string is
+    parsed once per time horizon."""
     if not ts_str:
         return None
     try:
+        # Fast path for the common Kalshi format "YYYY-MM-DDTHH:MM:SSZ"
+        if len(ts_str) == 20 and ts_str.endswith("Z"):
+            return datetime(
+                int(ts_str[0:4]), int(ts_str[5:7]), int(ts_str[8:10]),
+                int(ts_str[11:13]), int(ts_str[14:16]), int(ts_str[17:19]),
+                tzinfo=timezone.utc,
+            )
         return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
     except Exception:
         return None
 
+def precompute_price_index(market):
+    """Attach sorted int64 timestamps and close_dollars arrays to a market.
+
+    Done once per market so the three per-horizon lookups become binary
+    searches instead of full linear scans over the candlesticks.
+    """
+    ts_list = []
+    px_list = []
+    for c in market.get("candlesticks", []):
+        ts = c.get("end_period_ts")
+        if not ts:
+            continue
+        close_dollars = c.get("price", {}).get("close_dollars")
+        if close_dollars is None:
+            continue
+        try:
+            px = float(close_dollars)
+        except Exception:
+            continue
+        ts_list.append(ts)
+        px_list.append(px)
+    ts_arr = np.asarray(ts_list, dtype=np.int64)
+    order = np.argsort(ts_arr, kind="stable")
+    market["_ts"] = ts_arr[order]
+    market["_close_dollars"] = np.asarray(px_list, dtype=np.float64)[order]
+
+
 def get_price_before_close(market, days):
     """Return yes-price (0–1) from candlesticks ~N days before close."""
     close_dt = parse_iso(market.get("close_time"))
     if not close_dt:
         return None
     target_ts = int((close_dt - timedelta(days=days)).timestamp())
-    
-    cands = market.get("candlesticks", [])
-    if not cands:
-        return None
-    
-    # Find closest candlestick BEFORE or equal to target_ts
-    best = None
-    best_diff = float("inf")
-    for c in cands:
-        ts = c.get("end_period_ts")
-        if not ts:
-            continue
-        diff = target_ts - ts
-        if diff >= 0 and diff < best_diff:
-            best = c
-            best_diff = diff
-    if not best:
-        return None
 
-    close_dollars = best.get("price", {}).get("close_dollars")
-    if close_dollars is None:
+    # Index is attached on first use, so the helper also works on markets that
+    # were not pre-processed in main()
+    ts_arr = market.get("_ts")
+    if ts_arr is None:
+        precompute_price_index(market)
+        ts_arr = market["_ts"]
+    if ts_arr.size == 0:
         return None
-    try:
-        p = float(close_dollars)
-        return np.clip(p, 0.0, 1.0)
-    except Exception:
+
+    # Predecessor lookup (closest candle at or before target) in O(log N)
+    idx = np.searchsorted(ts_arr, target_ts, side="right") - 1
+    if idx < 0:
         return None
+    return float(np.clip(market["_close_dollars"][idx], 0.0, 1.0))
 
 
 # ---------- Main ----------
@@ -70,23 +96,37 @@ def main():
         col = db[col_name]
         print(f"\n=== Processing collection: {col_name} ===")
         print("Loading finalized markets...")
-        markets = list(col.find({"status": "finalized"}))
-        print(f"Loaded {len(markets)} finalized markets.")
-        
-        # Process markets for all time periods
-        for days, time_label in time_periods:
-            rows = []
-            for m in tqdm(markets, desc=f"Processing {col_name} - {time_label}", unit="mkt", leave=False):
-                result = (m.get("result") or "").lower()
-                if result not in {"yes", "no"}:
-                    continue
+        # Project only the fields the calibration needs — skips decoding the
+        # bulk of each candlestick document
+        projection = {
+            "_id": 0,
+            "ticker": 1,
+            "result": 1,
+            "close_time": 1,
+            "candlesticks.end_period_ts": 1,
+            "candlesticks.price.close_dollars": 1,
+        }
+        total = col.count_documents({"status": "finalized"})
+        print(f"Found {total} finalized markets.")
+
+        # Stream the cursor and handle every time period in one pass per
+        # market, so documents are decoded once and dropped right after
+        rows_by_period = {time_label: [] for _, time_label in time_periods}
+        cursor = col.find({"status": "finalized"}, projection).batch_size(200)
+        for m in tqdm(cursor, total=total, desc=f"Processing {col_name}", unit="mkt", leave=False):
+            result = (m.get("result") or "").lower()
+            if result not in {"yes", "no"}:
+                continue
+            y = 1 if result == "yes" else 0
+            ticker = m.get("ticker")
+            for days, time_label in time_periods:
                 p = get_price_before_close(m, days)
                 if p is None:
                     continue
-                y = 1 if result == "yes" else 0
-                rows.append({"ticker": m.get("ticker"), "prob": p, "outcome": y})
-            
-            df = pd.DataFrame(rows)
+                rows_by_period[time_label].append({"ticker": ticker, "prob": p, "outcome": y})
+
+        for _, time_label in time_periods:
+            df = pd.DataFrame(rows_by_period[time_label])
             print(f"{col_name} - {time_label}: {len(df)} valid rows")
             all_data[(col_name, time_label)] = df
 
@@ -108,12 +148,16 @@ def main():
         if len(df) == 0:
             continue
             
-        df["bin"] = pd.cut(df["prob"], bins=np.linspace(0, 1, n_bins + 1), include_lowest=True)
-        calib = (
-            df.groupby("bin")
-              .agg(mean_p=("prob", "mean"), freq_yes=("outcome", "mean"), n=("outcome", "count"))
-              .reset_index()
-        )
+        # Fixed-width bins, so the bin index is just floor(prob * n_bins) and
+        # the per-bin aggregates reduce to three bincount calls
+        prob = df["prob"].to_numpy()
+        outcome = df["outcome"].to_numpy(dtype=np.float64)
+        bin_idx = np.clip((prob * n_bins).astype(np.intp), 0, n_bins - 1)
+        n = np.bincount(bin_idx, minlength=n_bins)
+        sum_p = np.bincount(bin_idx, weights=prob, minlength=n_bins)
+        sum_y = np.bincount(bin_idx, weights=outcome, minlength=n_bins)
+        with np.errstate(invalid="ignore"):  # empty bins stay NaN, as with groupby
+            calib = pd.DataFrame({"mean_p": sum_p / n, "freq_yes": sum_y / n, "n": n})
         
         # Compute metrics
         calib["abs_err"] = (calib["mean_p"] - calib["freq_yes"]).abs()